@@ -2,17 +2,19 @@
 Class that Normalizes a Template based on Resource Metadata
 """
 
+import functools
 import logging
-from pathlib import Path
-import json
+import os
 import re
-from typing import Dict
+import sys
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
 
 from samcli.lib.iac.cdk.utils import is_cdk_project
 
 from samcli.lib.utils.resources import AWS_CLOUDFORMATION_STACK
 
 CDK_NESTED_STACK_RESOURCE_ID_SUFFIX = ".NestedStack"
+CDK_NESTED_STACK_RESOURCE_ID_SUFFIX_LENGTH = len(CDK_NESTED_STACK_RESOURCE_ID_SUFFIX)
 
 RESOURCES_KEY = "Resources"
 PROPERTIES_KEY = "Properties"
@@ -22,9 +24,12 @@ RESOURCE_CDK_PATH_METADATA_KEY = "aws:cdk:path"
 ASSET_PATH_METADATA_KEY = "aws:asset:path"
 ASSET_PROPERTY_METADATA_KEY = "aws:asset:property"
 
-IMAGE_ASSET_PROPERTY = "Code.ImageUri"
+# Interned, as it is compared against the interned asset properties of every resource
+IMAGE_ASSET_PROPERTY = sys.intern("Code.ImageUri")
 ASSET_DOCKERFILE_PATH_KEY = "aws:asset:dockerfile-path"
 ASSET_DOCKERFILE_BUILD_ARGS_KEY = "aws:asset:docker-build-args"
+# CDK omits the dockerfile path metadata if no file is specified, in which case Docker uses this one
+DEFAULT_DOCKERFILE = "Dockerfile"
 
 SAM_RESOURCE_ID_KEY = "SamResourceId"
 SAM_IS_NORMALIZED = "SamNormalized"
@@ -35,6 +40,7 @@ SAM_METADATA_DOCKER_BUILD_ARGS_KEY = "DockerBuildArgs"
 ASSET_BUNDLED_METADATA_KEY = "aws:asset:is-bundled"
 SAM_METADATA_SKIP_BUILD_KEY = "SkipBuild"
 
+CDK_ASSET_PARAMETER_PREFIX = "AssetParameters"
 # https://github.com/aws/aws-cdk/blob/b1ecd3d49d7ebf97a54a80d06779ef0f0b113c16/packages/%40aws-cdk/assert-internal/lib/canonicalize-assets.ts#L19
 CDK_ASSET_PARAMETER_PATTERN = re.compile(
     "^AssetParameters[0-9a-fA-F]{64}(?:S3Bucket|S3VersionKey|ArtifactHash)[0-9a-fA-F]{8}$"
@@ -45,6 +51,79 @@ BUILD_PROPERTIES_PASCAL_TO_SNAKE_CASE_PATTERN = re.compile(r"(?<!^)(?=[A-Z])")
 LOG = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=64)
+def _split_property_key(property_key: str) -> Tuple[str, ...]:
+    """
+    Split a dotted asset property key (for example `Code.ImageUri`) into its nested keys
+
+    Asset property keys repeat across most of the resources in a template, so the result is cached
+
+    Parameters
+    ----------
+    property_key: str
+        Dotted property key to split
+
+    Returns
+    -------
+    Tuple[str, ...]
+        The nested keys, from the outermost to the innermost one
+    """
+    return tuple(property_key.split("."))
+
+
+@functools.lru_cache(maxsize=256)
+def _normalize_image_asset_paths(asset_path: str, dockerfile_path: str) -> Tuple[str, str]:
+    """
+    Normalize the paths of an image asset
+
+    Image functions of the same CDK app usually share the same asset and dockerfile paths, so the result is cached
+
+    Parameters
+    ----------
+    asset_path: str
+        aws:asset:path metadata value of the image asset
+    dockerfile_path: str
+        aws:asset:dockerfile-path metadata value of the image asset
+
+    Returns
+    -------
+    Tuple[str, str]
+        The normalized dockerfile path, and the normalized docker context path
+    """
+    return os.path.normpath(dockerfile_path), os.path.normpath(asset_path)
+
+
+def _collect_ref_targets(obj: Any, out: Set[str]) -> None:
+    """
+    Collect the names of all the entities referenced using the `Ref` intrinsic function in the given object
+
+    The object is walked iteratively, so deeply nested templates do not hit the recursion limit
+
+    Parameters
+    ----------
+    obj: Any
+        Template fragment (dict, list or scalar) to look through
+    out: Set[str]
+        Set to add the referenced names to
+
+    """
+    # Only containers are pushed to the stack, as scalar values can not hold any reference
+    stack = [obj] if isinstance(obj, (dict, list)) else []
+    children: Iterable[Any]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if len(node) == 1:
+                ref_target = node.get("Ref")
+                if isinstance(ref_target, str):
+                    out.add(ref_target)
+                    continue
+            children = node.values()
+        else:
+            children = node
+        stack.extend(child for child in children if isinstance(child, (dict, list)))
+
+
 class ResourceMetadataNormalizer:
     @staticmethod
     def normalize(template_dict, normalize_parameters=False):
@@ -60,44 +139,16 @@ class ResourceMetadataNormalizer:
 
         """
         resources = template_dict.get(RESOURCES_KEY, {})
+        normalize_cdk_parameters = normalize_parameters and is_cdk_project(template_dict)
 
-        for logical_id, resource in resources.items():
-            resource_metadata = resource.get(METADATA_KEY)
-            if resource_metadata is None:
-                resource_metadata = {}
-                resource[METADATA_KEY] = resource_metadata
+        # Names referenced by the resources, used to normalize the CDK parameters below. They are collected while
+        # normalizing the resources, so the template is only walked once
+        ref_targets: Set[str] = set()
 
-            is_normalized = resource_metadata.get(SAM_IS_NORMALIZED, False)
-            if not is_normalized:
-                asset_property = resource_metadata.get(ASSET_PROPERTY_METADATA_KEY)
-                if asset_property == IMAGE_ASSET_PROPERTY:
-                    asset_metadata = ResourceMetadataNormalizer._extract_image_asset_metadata(resource_metadata)
-                    ResourceMetadataNormalizer._update_resource_metadata(resource_metadata, asset_metadata)
-                    # For image-type functions, the asset path is expected to be the name of the Docker image.
-                    # When building, we set the name of the image to be the logical id of the function.
-                    asset_path = logical_id.lower()
-                else:
-                    asset_path = resource_metadata.get(ASSET_PATH_METADATA_KEY)
-
-                ResourceMetadataNormalizer._replace_property(asset_property, asset_path, resource, logical_id)
-                if asset_path and asset_property:
-                    resource_metadata[SAM_IS_NORMALIZED] = True
-
-            # Set SkipBuild metadata iff is-bundled metadata exists, and value is True
-            skip_build = resource_metadata.get(ASSET_BUNDLED_METADATA_KEY, False)
-            if skip_build:
-                ResourceMetadataNormalizer._update_resource_metadata(
-                    resource_metadata,
-                    {
-                        SAM_METADATA_SKIP_BUILD_KEY: True,
-                    },
-                )
-
-            # Set Resource Id
-            ResourceMetadataNormalizer._update_resource_metadata(
-                resource_metadata,
-                {SAM_RESOURCE_ID_KEY: ResourceMetadataNormalizer.get_resource_id(resource, logical_id)},
-            )
+        for logical_id, resource in resources.items():
+            ResourceMetadataNormalizer._normalize_resource(logical_id, resource)
+            if normalize_cdk_parameters and resource.get("Type", "") != AWS_CLOUDFORMATION_STACK:
+                _collect_ref_targets(resource, ref_targets)
 
         # This is a work around to allow the customer to use sam deploy or package commands without the need to provide
         # values for the CDK auto generated asset parameters. The suggested solution is to let CDK add some metadata to
@@ -113,27 +164,81 @@ class ResourceMetadataNormalizer:
         # We set an empty string as default value for the matching parameters, so the customer can use sam deploy or
         # package commands without providing values for the auto generated parameters, as these parameters are not used
         # in SAM (sam set the resources paths directly, and does not depend on template parameters)
-        if normalize_parameters and is_cdk_project(template_dict):
-            resources_copy = {
-                logical_id: resource
-                for logical_id, resource in resources.items()
-                if resource.get("Type", "") != AWS_CLOUDFORMATION_STACK
-            }
-            resources_as_string = json.dumps(resources_copy)
+        if normalize_cdk_parameters:
             parameters = template_dict.get("Parameters", {})
 
             default_value = " "
-            for parameter_name, parameter_value in parameters.items():
-                parameter_name_match = CDK_ASSET_PARAMETER_PATTERN.match(parameter_name)
+            # Cheap prefix check first, so the pattern is only matched against the candidate asset parameters
+            asset_parameters = [
+                (parameter_name, parameter_value)
+                for parameter_name, parameter_value in parameters.items()
+                if parameter_name.startswith(CDK_ASSET_PARAMETER_PREFIX)
+            ]
+            for parameter_name, parameter_value in asset_parameters:
                 if (
-                    parameter_name_match
-                    and "Default" not in parameter_value
+                    "Default" not in parameter_value
                     and parameter_value.get("Type", "") == "String"
-                    and f'"Ref": "{parameter_name}"' not in resources_as_string
+                    and CDK_ASSET_PARAMETER_PATTERN.match(parameter_name)
+                    and parameter_name not in ref_targets
                 ):
                     LOG.debug("set default value for parameter %s to '%s'", parameter_name, default_value)
                     parameter_value["Default"] = default_value
 
+    @staticmethod
+    def _normalize_resource(logical_id, resource):
+        """
+        Normalize a Resource based on its Metadata
+
+        This method will mutate the template
+
+        Parameters
+        ----------
+        logical_id str
+            LogicalId of the Resource
+        resource dict
+            Dictionary representing the Resource to normalize
+
+        """
+        resource_metadata = resource.get(METADATA_KEY)
+        if not resource_metadata:
+            # Without any metadata there is nothing to normalize, and the resource id is the logical id
+            if resource_metadata is None:
+                resource_metadata = {}
+                resource[METADATA_KEY] = resource_metadata
+            resource_metadata[SAM_RESOURCE_ID_KEY] = logical_id
+            return
+
+        is_normalized = resource_metadata.get(SAM_IS_NORMALIZED, False)
+        if not is_normalized:
+            asset_property = resource_metadata.get(ASSET_PROPERTY_METADATA_KEY)
+            if isinstance(asset_property, str):
+                # The same few asset properties repeat across resources, interning them lets the comparisons and
+                # the cached key splitting below match them by identity
+                asset_property = sys.intern(asset_property)
+            if asset_property == IMAGE_ASSET_PROPERTY:
+                asset_metadata = ResourceMetadataNormalizer._extract_image_asset_metadata(resource_metadata)
+                resource_metadata.update(asset_metadata)
+                # For image-type functions, the asset path is expected to be the name of the Docker image.
+                # When building, we set the name of the image to be the logical id of the function.
+                asset_path = logical_id.lower()
+            else:
+                asset_path = resource_metadata.get(ASSET_PATH_METADATA_KEY)
+
+            ResourceMetadataNormalizer._replace_property(asset_property, asset_path, resource, logical_id)
+            if asset_path and asset_property:
+                resource_metadata[SAM_IS_NORMALIZED] = True
+
+        # Set SkipBuild metadata iff is-bundled metadata exists, and value is True, unless it is already set
+        skip_build = resource_metadata.get(ASSET_BUNDLED_METADATA_KEY, False)
+        if skip_build and SAM_METADATA_SKIP_BUILD_KEY not in resource_metadata:
+            resource_metadata[SAM_METADATA_SKIP_BUILD_KEY] = True
+
+        # Set Resource Id, unless it is already defined by the customer or by a previous normalization, in which
+        # case get_resource_id would return that same value
+        resource_id = resource_metadata.get(SAM_RESOURCE_ID_KEY)
+        if not isinstance(resource_id, str) or not resource_id:
+            resource_metadata[SAM_RESOURCE_ID_KEY] = ResourceMetadataNormalizer.get_resource_id(resource, logical_id)
+
     @staticmethod
     def _replace_property(property_key, property_value, resource, logical_id):
         """
@@ -154,13 +259,21 @@ class ResourceMetadataNormalizer:
 
         """
         if property_key and property_value:
-            nested_keys = property_key.split(".")
-            target_dict = resource.get(PROPERTIES_KEY, {})
-            while len(nested_keys) > 1:
-                key = nested_keys.pop(0)
-                target_dict[key] = {}
-                target_dict = target_dict[key]
-            target_dict[nested_keys[0]] = property_value
+            target_dict = resource.setdefault(PROPERTIES_KEY, {})
+            if "." not in property_key:
+                # Top level properties (e.g. Code, TemplateURL) are the most common case
+                target_dict[property_key] = property_value
+                return
+
+            *parent_keys, leaf_key = _split_property_key(property_key)
+            for key in parent_keys:
+                # Reuse the existing nested properties, and only create the ones that are missing
+                nested_dict = target_dict.get(key)
+                if not isinstance(nested_dict, dict):
+                    nested_dict = {}
+                    target_dict[key] = nested_dict
+                target_dict = nested_dict
+            target_dict[leaf_key] = property_value
         elif property_key or property_value:
             LOG.info(
                 "WARNING: Ignoring Metadata for Resource %s. Metadata contains only aws:asset:path or "
@@ -184,32 +297,16 @@ class ResourceMetadataNormalizer:
             metadata properties for image-type lambda function
 
         """
-        asset_path = Path(metadata.get(ASSET_PATH_METADATA_KEY, ""))
-        dockerfile_path = Path(metadata.get(ASSET_DOCKERFILE_PATH_KEY), "")
+        dockerfile_path, asset_path = _normalize_image_asset_paths(
+            metadata.get(ASSET_PATH_METADATA_KEY) or "",
+            metadata.get(ASSET_DOCKERFILE_PATH_KEY) or DEFAULT_DOCKERFILE,
+        )
         return {
-            SAM_METADATA_DOCKERFILE_KEY: str(dockerfile_path),
-            SAM_METADATA_DOCKER_CONTEXT_KEY: str(asset_path),
+            SAM_METADATA_DOCKERFILE_KEY: dockerfile_path,
+            SAM_METADATA_DOCKER_CONTEXT_KEY: asset_path,
             SAM_METADATA_DOCKER_BUILD_ARGS_KEY: metadata.get(ASSET_DOCKERFILE_BUILD_ARGS_KEY, {}),
         }
 
-    @staticmethod
-    def _update_resource_metadata(metadata, updated_values):
-        """
-        Update the metadata values for image-type lambda functions
-
-        This method will mutate the template
-
-        Parameters
-        ----------
-        metadata dict
-            Metadata dict to be updated
-        updated_values dict
-            Dict of key-value pairs to append to the existing metadata
-
-        """
-        for key, val in updated_values.items():
-            metadata[key] = val
-
     @staticmethod
     def get_resource_id(resource_properties, logical_id):
         """
@@ -250,33 +347,59 @@ class ResourceMetadataNormalizer:
             )
             return logical_id
 
-        # aws:cdk:path metadata format of functions: {stack_id}/{function_id}/Resource
-        # Design doc of CDK path: https://github.com/aws/aws-cdk/blob/master/design/construct-tree.md
-        cdk_path_partitions = resource_cdk_path.split("/")
+        is_nested_stack = resource_properties.get("Type", "") == AWS_CLOUDFORMATION_STACK
+        cdk_resource_id = ResourceMetadataNormalizer._get_cdk_resource_id(resource_cdk_path, is_nested_stack)
 
-        LOG.debug("CDK Path for resource %s is %s", logical_id, cdk_path_partitions)
+        LOG.debug("CDK Path for resource %s is %s", logical_id, resource_cdk_path)
 
-        if len(cdk_path_partitions) < 2:
+        if cdk_resource_id is None:
             LOG.warning(
                 "Cannot detect function id from aws:cdk:path metadata '%s', using default logical id", resource_cdk_path
             )
             return logical_id
 
-        cdk_resource_id = (
-            cdk_path_partitions[-2]
-            if cdk_path_partitions[-1] == "Resource"
-            or (
-                resource_properties.get("Type", "") == AWS_CLOUDFORMATION_STACK
-                and cdk_path_partitions[-2].endswith(CDK_NESTED_STACK_RESOURCE_ID_SUFFIX)
-            )
-            else cdk_path_partitions[-1]
-        )
+        return cdk_resource_id
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _get_cdk_resource_id(resource_cdk_path: str, is_nested_stack: bool) -> Optional[str]:
+        """
+        Extract the cdk-defined resource id from the aws:cdk:path metadata of a resource
+
+        The same resources are looked up many times during a command, and the result only depends on the arguments, so
+        it is cached
+
+        Parameters
+        ----------
+        resource_cdk_path str
+            aws:cdk:path metadata value of the resource
+        is_nested_stack bool
+            True if the resource is a nested stack
+
+        Returns
+        -------
+        Optional[str]
+            The cdk-defined resource id, or None if it can not be detected from the cdk path
+        """
+        # aws:cdk:path metadata format of functions: {stack_id}/{function_id}/Resource
+        # Design doc of CDK path: https://github.com/aws/aws-cdk/blob/master/design/construct-tree.md
+        # Only the last two partitions are needed, so do not split the whole path
+        cdk_path_partitions = resource_cdk_path.rsplit("/", 2)
+
+        if len(cdk_path_partitions) < 2:
+            return None
+
+        parent_partition, last_partition = cdk_path_partitions[-2], cdk_path_partitions[-1]
+
+        # Nested stack format: {parent_stack_id}/{nested_stack_id}.NestedStack/{nested_stack_id}.NestedStackResource
+        if is_nested_stack and parent_partition.endswith(CDK_NESTED_STACK_RESOURCE_ID_SUFFIX):
+            return parent_partition[:-CDK_NESTED_STACK_RESOURCE_ID_SUFFIX_LENGTH]
+
+        cdk_resource_id = parent_partition if last_partition == "Resource" else last_partition
 
         # Check if the Resource is nested Stack
-        if resource_properties.get("Type", "") == AWS_CLOUDFORMATION_STACK and cdk_resource_id.endswith(
-            CDK_NESTED_STACK_RESOURCE_ID_SUFFIX
-        ):
-            cdk_resource_id = cdk_resource_id[: -len(CDK_NESTED_STACK_RESOURCE_ID_SUFFIX)]
+        if is_nested_stack and cdk_resource_id.endswith(CDK_NESTED_STACK_RESOURCE_ID_SUFFIX):
+            cdk_resource_id = cdk_resource_id[:-CDK_NESTED_STACK_RESOURCE_ID_SUFFIX_LENGTH]
 
         return cdk_resource_id
 
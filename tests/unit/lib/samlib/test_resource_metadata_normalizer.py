@@ -1,4 +1,6 @@
+import os
 import pathlib
+from collections import OrderedDict
 from parameterized import parameterized
 from unittest import TestCase
 
@@ -52,6 +54,45 @@ class TestResourceMetadataNormalizer(TestCase):
         self.assertEqual(True, template_data["Resources"]["Function1"]["Metadata"]["SamNormalized"])
         self.assertEqual("CDKFunction1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
 
+    def test_replace_nested_property_keeps_sibling_properties(self):
+        template_data = {
+            "Resources": {
+                "Function1": {
+                    "Properties": {
+                        "Code": {
+                            "S3Bucket": "some bucket",
+                            "S3Key": "some key",
+                        }
+                    },
+                    "Metadata": {"aws:asset:path": "new path", "aws:asset:property": "Code.S3Key"},
+                }
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+
+        self.assertEqual(
+            {"S3Bucket": "some bucket", "S3Key": "new path"},
+            template_data["Resources"]["Function1"]["Properties"]["Code"],
+        )
+
+    def test_replace_deeply_nested_property(self):
+        template_data = {
+            "Resources": {
+                "Resource1": {
+                    "Properties": {"Level1": {"Level2": "some value", "Sibling": "sibling value"}},
+                    "Metadata": {"aws:asset:path": "new path", "aws:asset:property": "Level1.Level2.Level3.Level4"},
+                }
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+
+        self.assertEqual(
+            {"Level2": {"Level3": {"Level4": "new path"}}, "Sibling": "sibling value"},
+            template_data["Resources"]["Resource1"]["Properties"]["Level1"],
+        )
+
     def test_replace_all_resources_that_contain_metadata(self):
         template_data = {
             "Resources": {
@@ -187,6 +228,49 @@ class TestResourceMetadataNormalizer(TestCase):
         self.assertEqual(docker_build_args, template_data["Resources"]["Function1"]["Metadata"]["DockerBuildArgs"])
         self.assertEqual("Function1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
 
+    def test_replace_all_resources_that_contain_image_metadata_without_dockerfile_path(self):
+        template_data = {
+            "Resources": {
+                "Function1": {
+                    "Properties": {"Code": {"ImageUri": "some image uri"}},
+                    "Metadata": {
+                        "aws:asset:path": "/path/to/asset",
+                        "aws:asset:property": "Code.ImageUri",
+                    },
+                },
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+
+        self.assertEqual("function1", template_data["Resources"]["Function1"]["Properties"]["Code"]["ImageUri"])
+        self.assertEqual(
+            str(pathlib.Path("/path/to/asset")), template_data["Resources"]["Function1"]["Metadata"]["DockerContext"]
+        )
+        self.assertEqual("Dockerfile", template_data["Resources"]["Function1"]["Metadata"]["Dockerfile"])
+        self.assertEqual({}, template_data["Resources"]["Function1"]["Metadata"]["DockerBuildArgs"])
+
+    def test_image_metadata_paths_are_normalized(self):
+        template_data = {
+            "Resources": {
+                "Function1": {
+                    "Properties": {"Code": {"ImageUri": "some image uri"}},
+                    "Metadata": {
+                        "aws:asset:path": "path/to/../asset/",
+                        "aws:asset:property": "Code.ImageUri",
+                        "aws:asset:dockerfile-path": "./docker/../Dockerfile",
+                    },
+                },
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+
+        self.assertEqual(
+            os.path.join("path", "asset"), template_data["Resources"]["Function1"]["Metadata"]["DockerContext"]
+        )
+        self.assertEqual("Dockerfile", template_data["Resources"]["Function1"]["Metadata"]["Dockerfile"])
+
     def test_tempate_without_metadata(self):
         template_data = {"Resources": {"Function1": {"Properties": {"Code": "some value"}}}}
 
@@ -242,6 +326,20 @@ class TestResourceMetadataNormalizer(TestCase):
         self.assertEqual("new path", template_data["Resources"]["Function1"]["Properties"]["Code"])
         self.assertEqual("Function1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
 
+    def test_replace_property_of_resource_without_properties(self):
+        template_data = {
+            "Resources": {
+                "Function1": {
+                    "Metadata": {"aws:asset:path": "new path", "aws:asset:property": "Code.S3Key"},
+                }
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+
+        self.assertEqual({"Code": {"S3Key": "new path"}}, template_data["Resources"]["Function1"]["Properties"])
+        self.assertEqual(True, template_data["Resources"]["Function1"]["Metadata"]["SamNormalized"])
+
     def test_set_skip_build_metadata_for_bundled_assets_metadata_equals_true(self):
         template_data = {
             "Resources": {
@@ -261,6 +359,25 @@ class TestResourceMetadataNormalizer(TestCase):
         self.assertTrue(template_data["Resources"]["Function1"]["Metadata"]["SkipBuild"])
         self.assertEqual("Function1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
 
+    def test_skip_build_metadata_is_not_overridden_if_already_set(self):
+        template_data = {
+            "Resources": {
+                "Function1": {
+                    "Properties": {"Code": "some value"},
+                    "Metadata": {
+                        "aws:asset:path": "new path",
+                        "aws:asset:property": "Code",
+                        "aws:asset:is-bundled": True,
+                        "SkipBuild": False,
+                    },
+                }
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+
+        self.assertFalse(template_data["Resources"]["Function1"]["Metadata"]["SkipBuild"])
+
     def test_no_skip_build_metadata_for_bundled_assets_metadata_equals_false(self):
         template_data = {
             "Resources": {
@@ -430,6 +547,86 @@ class TestResourceMetadataNormalizer(TestCase):
             ].get("Default")
         )
 
+    def test_cdk_template_parameters_referenced_in_nested_intrinsics_should_not_be_normalized(self):
+        referenced_parameter = (
+            "AssetParametersb9866fd422d32492c62394e8c406ab4004f0c80364bab4957e67e31cf1130481S3Bucket0A652998"
+        )
+        unreferenced_parameter = (
+            "AssetParametersb9866fd422d32492c62394e8c406ab4004f0c80364bab4957e67e31cf1130481S3VersionKey0A652998"
+        )
+        template_data = {
+            "Parameters": {
+                referenced_parameter: {"Type": "String"},
+                unreferenced_parameter: {"Type": "String"},
+            },
+            "Resources": {
+                "CDKMetadata": {
+                    "Type": "AWS::CDK::Metadata",
+                    "Properties": {"Analytics": "v2:deflate64:H4s"},
+                },
+                "Function1": {
+                    "Properties": {
+                        "Code": {
+                            "S3Bucket": {"Fn::Join": ["", [{"Ref": referenced_parameter}, "-suffix"]]},
+                            "S3Key": "key.zip",
+                        }
+                    },
+                },
+            },
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data, True)
+
+        self.assertIsNone(template_data["Parameters"][referenced_parameter].get("Default"))
+        self.assertEqual(template_data["Parameters"][unreferenced_parameter]["Default"], " ")
+
+    def test_cdk_template_parameters_only_referenced_by_replaced_properties_should_be_normalized(self):
+        asset_parameter = (
+            "AssetParametersb9866fd422d32492c62394e8c406ab4004f0c80364bab4957e67e31cf1130481S3Bucket0A652998"
+        )
+        template_data = {
+            "Parameters": {asset_parameter: {"Type": "String"}},
+            "Resources": {
+                "Function1": {
+                    "Properties": {"Code": {"S3Bucket": {"Ref": asset_parameter}, "S3Key": "key.zip"}},
+                    "Metadata": {
+                        "aws:cdk:path": "Stack/Function1/Resource",
+                        "aws:asset:path": "new path",
+                        "aws:asset:property": "Code",
+                    },
+                },
+            },
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data, True)
+
+        self.assertEqual("new path", template_data["Resources"]["Function1"]["Properties"]["Code"])
+        self.assertEqual(template_data["Parameters"][asset_parameter]["Default"], " ")
+
+    def test_cdk_template_parameters_referenced_in_ordered_dicts_should_not_be_normalized(self):
+        # yaml_parse loads templates into OrderedDicts
+        referenced_parameter = (
+            "AssetParametersb9866fd422d32492c62394e8c406ab4004f0c80364bab4957e67e31cf1130481S3Bucket0A652998"
+        )
+        template_data = {
+            "Parameters": {referenced_parameter: {"Type": "String"}},
+            "Resources": OrderedDict(
+                [
+                    ("CDKMetadata", OrderedDict([("Type", "AWS::CDK::Metadata")])),
+                    (
+                        "Function1",
+                        OrderedDict(
+                            [("Properties", OrderedDict([("Code", OrderedDict([("Ref", referenced_parameter)]))]))]
+                        ),
+                    ),
+                ]
+            ),
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data, True)
+
+        self.assertIsNone(template_data["Parameters"][referenced_parameter].get("Default"))
+
     def test_skip_normalizing_already_normalized_resource(self):
         template_data = {
             "Resources": {
@@ -456,12 +653,44 @@ class TestResourceMetadataNormalizer(TestCase):
         self.assertEqual("new path", template_data["Resources"]["Function1"]["Properties"]["Code"])
         self.assertEqual("Function1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
 
+    def test_keep_resource_id_of_already_normalized_resource(self):
+        template_data = {
+            "Resources": {
+                "Function1": {
+                    "Properties": {"Code": "some value"},
+                    "Metadata": {"aws:cdk:path": "Stack/CDKFunction1/Resource"},
+                }
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+        self.assertEqual("CDKFunction1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
+
+        template_data["Resources"]["Function1"]["Metadata"]["aws:cdk:path"] = "Stack/UpdatedCDKFunction1/Resource"
+        ResourceMetadataNormalizer.normalize(template_data)
+        self.assertEqual("CDKFunction1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
+
+    def test_invalid_resource_id_is_replaced(self):
+        template_data = {
+            "Resources": {
+                "Function1": {
+                    "Properties": {"Code": "some value"},
+                    "Metadata": {"aws:cdk:path": "Stack/CDKFunction1/Resource", "SamResourceId": ""},
+                }
+            }
+        }
+
+        ResourceMetadataNormalizer.normalize(template_data)
+
+        self.assertEqual("CDKFunction1", template_data["Resources"]["Function1"]["Metadata"]["SamResourceId"])
+
 
 class TestResourceMetadataNormalizerGetResourceId(TestCase):
     @parameterized.expand(
         [
             ("stack_id/func_cdk_id/Resource", "func_cdk_id"),
             ("stack_id/serverless_func_cdk_id", "serverless_func_cdk_id"),
+            ("stack_id/construct_id/nested_construct_id/func_cdk_id/Resource", "func_cdk_id"),
         ]
     )
     def test_use_cdk_id_as_resource_id(self, cdk_path, expected_resource_id):
@@ -476,6 +705,23 @@ class TestResourceMetadataNormalizerGetResourceId(TestCase):
 
         self.assertEqual(expected_resource_id, resource_id)
 
+    def test_same_cdk_path_resolves_to_resource_id_based_on_resource_type(self):
+        cdk_path = "parent_stack_id/nested_stack_id.NestedStack/nested_stack_id.NestedStackResource"
+
+        nested_stack_resource_id = ResourceMetadataNormalizer.get_resource_id(
+            {"Type": "AWS::CloudFormation::Stack", "Metadata": {"aws:cdk:path": cdk_path}}, "logical_id"
+        )
+        other_resource_id = ResourceMetadataNormalizer.get_resource_id(
+            {"Type": "any:value", "Metadata": {"aws:cdk:path": cdk_path}}, "logical_id"
+        )
+        nested_stack_resource_id_again = ResourceMetadataNormalizer.get_resource_id(
+            {"Type": "AWS::CloudFormation::Stack", "Metadata": {"aws:cdk:path": cdk_path}}, "other_logical_id"
+        )
+
+        self.assertEqual("nested_stack_id", nested_stack_resource_id)
+        self.assertEqual("nested_stack_id.NestedStackResource", other_resource_id)
+        self.assertEqual("nested_stack_id", nested_stack_resource_id_again)
+
     def test_use_logical_id_as_resource_id_incase_of_invalid_cdk_path(self):
         resource_id = ResourceMetadataNormalizer.get_resource_id(
             {"Type": "any:value", "Properties": {"key": "value"}, "Metadata": {"aws:cdk:path": "func_cdk_id"}},
@@ -498,6 +744,18 @@ class TestResourceMetadataNormalizerGetResourceId(TestCase):
 
         self.assertEqual("nested_stack_id", resource_id)
 
+    def test_use_cdk_id_as_resource_id_for_nested_stack_without_resource_partition(self):
+        resource_id = ResourceMetadataNormalizer.get_resource_id(
+            {
+                "Type": "AWS::CloudFormation::Stack",
+                "Properties": {"key": "value"},
+                "Metadata": {"aws:cdk:path": "parent_stack_id/nested_stack_id.NestedStack"},
+            },
+            "logical_id",
+        )
+
+        self.assertEqual("nested_stack_id", resource_id)
+
     def test_use_provided_customer_defined_id(self):
         resource_id = ResourceMetadataNormalizer.get_resource_id(
             {